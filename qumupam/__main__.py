@@ -2,7 +2,7 @@ import os
 import sys
 import platform
 import time
-from pytermgui import tim
+import asyncio
 from qumupam.utilities import (
     download_adb,
     get_unsafe_to_uninstall,
@@ -10,15 +10,20 @@ from qumupam.utilities import (
     uninstall_success_regex,
     ADBStatus,
     Mode,
+    SuccessPrinter,
+    AsyncPmSessionPool,
+    get_concurrency,
     check_for_adb,
     get_packages,
     get_users,
-    install_existing,
+    get_install_command,
     prompt_for_mode,
     prompt_for_packages,
     prompt_for_preserve_data,
     prompt_for_user,
-    uninstall,
+    resolve_labels,
+    get_uninstall_command,
+    process_packages,
     wait_for_device,
     check_aapt2_works,
     download_aapt2,
@@ -26,6 +31,8 @@ from qumupam.utilities import (
 
 
 def main():
+    from pytermgui import tim
+
     adb_status = check_for_adb()
 
     if adb_status == ADBStatus.Unavailible:
@@ -46,14 +53,7 @@ def main():
         )
         wait_for_device()
 
-    if not check_aapt2_works():
-        download_aapt2()
-
-    tim.print(
-        "[grey]INFO:[/] Gathering package information...\n"
-        "[green]HINT:[/]This can be slow on the first run, be patient!"
-    )
-    all_packages = get_packages()
+    tim.print("[grey]INFO:[/] Gathering user information...")
     users = get_users()
 
     user = prompt_for_user(users)
@@ -66,33 +66,53 @@ def main():
     if mode is None:
         return
 
+    if mode in (Mode.InstallAll, Mode.Select):
+        all_packages = get_packages()
+
+    # only the package selection shows labels, which are the slow part to gather
+    if mode == Mode.Select:
+        if not check_aapt2_works():
+            download_aapt2()
+
+        tim.print(
+            "[grey]INFO:[/] Gathering package information...\n"
+            "[green]HINT:[/]This can be slow on the first run, be patient!"
+        )
+        # fills in labels of the packages in user.packages too
+        resolve_labels(all_packages)
+
     pending_install = set()
     pending_uninstall = set()
 
     if mode == Mode.InstallAll:
         pending_install = all_packages.difference(user.packages)
     elif mode == Mode.UninstallAll:
-        pending_uninstall = user.packages
+        pending_uninstall = set(user.packages)
     elif mode == Mode.Select:
         new_packages = prompt_for_packages(all_packages, user.packages)
         if new_packages is None:
             return
         new_packages = set(new_packages)
-        pending_install = new_packages.difference(user.packages)
-        pending_uninstall = user.packages.difference(new_packages)
+        for package in new_packages ^ user.packages:
+            if package in new_packages:
+                pending_install.add(package)
+            else:
+                pending_uninstall.add(package)
 
     preserve_data = True
-    if pending_uninstall != set():
+    if pending_uninstall:
         preserve_data = prompt_for_preserve_data()
         if preserve_data is None:
             return
 
     unsafe_to_uninstall = get_unsafe_to_uninstall(users)
 
-    pending_unsafe = pending_uninstall.intersection(unsafe_to_uninstall)
+    pending_unsafe = {
+        package for package in pending_uninstall if package in unsafe_to_uninstall
+    }
     remove_packages = False
 
-    if pending_unsafe != set():
+    if pending_unsafe:
         tim.print(
             "[red]IMPORTANT WARNING:[/] You are trying to uninstall packages from the "
             "last user that has them. That would break them, and to avoid confusion, "
@@ -111,40 +131,62 @@ def main():
 
     time_start = time.time()
 
-    errors_encountered = False
-
-    if mode != Mode.UninstallAll and pending_install == set():
-        tim.print("[grey]INFO:[/] No packages to install!")
-    elif pending_install != set():
-        for package in pending_install:
-            output = install_existing(package, user.uid)
-            if not install_success_regex.match(output):
-                tim.print(
-                    "[orange]WARNING:[/] Encountered the following "
-                    f"unexpected output while installing {package}:\n"
-                    "         - " + output
-                )
-                errors_encountered = True
-            else:
-                tim.print(f"[green]SUCCESS:[/] Installed {package}.")
-
-    if mode != Mode.InstallAll and pending_uninstall == set():
-        tim.print("[grey]INFO:[/] No packages to uninstall!")
-    elif pending_uninstall != set():
-        for package in pending_uninstall:
-            if remove_packages and package in pending_unsafe:
-                output = uninstall(package, None, preserve_data=preserve_data)
-            else:
-                output = uninstall(package, user.uid, preserve_data=preserve_data)
-            if not uninstall_success_regex.match(output):
-                tim.print(
-                    "[orange]WARNING:[/] Encountered the following "
-                    f"unexpected output while uninstalling {package}:\n"
-                    "         - " + output
-                )
-                errors_encountered = True
-            else:
-                tim.print(f"[green]SUCCESS:[/] Uninstalled {package}.")
+    def install(package):
+        return get_install_command(package, user.uid)
+
+    def remove(package):
+        if remove_packages and package in pending_unsafe:
+            uid = None
+        else:
+            uid = user.uid
+        return get_uninstall_command(package, uid, preserve_data)
+
+    async def process(sessions, successes) -> bool:
+        errors_encountered = False
+
+        if mode != Mode.UninstallAll and not pending_install:
+            tim.print("[grey]INFO:[/] No packages to install!")
+        elif pending_install:
+            async for package, output in process_packages(
+                pending_install, install, sessions
+            ):
+                if not install_success_regex.match(output):
+                    successes.flush()
+                    tim.print(
+                        "[orange]WARNING:[/] Encountered the following "
+                        f"unexpected output while installing {package}:\n"
+                        "         - " + output
+                    )
+                    errors_encountered = True
+                else:
+                    successes.print(f"Installed {package}.")
+            successes.flush()
+
+        if mode != Mode.InstallAll and not pending_uninstall:
+            tim.print("[grey]INFO:[/] No packages to uninstall!")
+        elif pending_uninstall:
+            async for package, output in process_packages(
+                pending_uninstall, remove, sessions
+            ):
+                if not uninstall_success_regex.match(output):
+                    successes.flush()
+                    tim.print(
+                        "[orange]WARNING:[/] Encountered the following "
+                        f"unexpected output while uninstalling {package}:\n"
+                        "         - " + output
+                    )
+                    errors_encountered = True
+                else:
+                    successes.print(f"Uninstalled {package}.")
+
+        return errors_encountered
+
+    async def process_with_sessions() -> bool:
+        async with AsyncPmSessionPool(get_concurrency()) as sessions:
+            with SuccessPrinter() as successes:
+                return await process(sessions, successes)
+
+    errors_encountered = asyncio.run(process_with_sessions())
 
     if errors_encountered:
         tim.print(
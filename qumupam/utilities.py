@@ -1,22 +1,28 @@
 #!/usr/bin/env python3
 
-from io import BytesIO
+import asyncio
+import atexit
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import asynccontextmanager, closing, contextmanager
+import os
 from pathlib import Path
 import platform
 import re
+import shlex
+import shutil
 import stat
-from subprocess import CalledProcessError, check_output, DEVNULL
+from subprocess import CalledProcessError, Popen, check_output, DEVNULL, PIPE
 from enum import Enum
+import sqlite3
 import sys
-from typing import Iterable, NamedTuple, Optional
-import inquirer as inq
-from tempfile import TemporaryDirectory
+import threading
+import time
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator, NamedTuple, Optional
+from tempfile import TemporaryFile
 import urllib.request
-from tqdm import tqdm
-from cachier import cachier
 import zipfile
 
-
 AAPT2_PATH_ON_DEVICE = "/data/local/tmp/aapt2"
 ADB_URL_WINDOWS = (
     "https://dl.google.com/android/repository/platform-tools-latest-windows.zip"
@@ -40,8 +46,23 @@ def get_adb_url():
         raise NotImplementedError(f"No ADB for system {platform.system()}")
 
 
+DEFAULT_CONCURRENCY = 8
+
+
+def get_concurrency() -> int:
+    try:
+        return max(1, int(os.environ["QUMUPAM_CONCURRENCY"]))
+    except (KeyError, ValueError):
+        return DEFAULT_CONCURRENCY
+
+
 CACHE_FOLDER = Path.home() / ".cache" / "qumupam"
 ADB_PATH = CACHE_FOLDER / "platform-tools" / "adb"
+LABEL_CACHE_PATH = CACHE_FOLDER / "apk_labels.sqlite"
+# which way of getting labels worked last time, so it isn't probed for again
+LABEL_SOURCE_PATH = CACHE_FOLDER / "label_source"
+# the aapt2 binary for the device, kept so it isn't downloaded again
+AAPT2_PATH = CACHE_FOLDER / "aapt2"
 
 
 if platform.system() == "Windows":
@@ -60,20 +81,361 @@ def run_cmd(cmd: list[str], silent=False) -> str:
     )
 
 
+def run_cmd_bytes(cmd: list[str], silent=False) -> bytes:
+    """Like run_cmd, but skips decoding, for output that's parsed as bytes."""
+    return check_output(cmd, stderr=DEVNULL if silent else sys.stderr)
+
+
+def run_cmd_lines(cmd: list[str], silent=False) -> Iterator[bytes]:
+    """Like run_cmd_bytes, but yields the output line by line as it arrives,
+    so it can be parsed while the command is still running."""
+    with Popen(cmd, stdout=PIPE, stderr=DEVNULL if silent else sys.stderr) as proc:
+        yield from proc.stdout
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd)
+
+
+async def a_run_cmd(cmd: list[str], silent=False) -> str:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=PIPE, stderr=DEVNULL if silent else None
+    )
+    stdout, _ = await proc.communicate()
+    output = stdout.decode("UTF-8")
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, output)
+    return output
+
+
+SESSION_SENTINEL = b"__QUMUPAM_END__"
+
+
+def format_session_command(cmd: list[str] | str, silent: bool) -> bytes:
+    # a str is a whole shell script, a list is a single command to quote
+    line = cmd if isinstance(cmd, str) else shlex.join(cmd)
+    redirect = b" 2>/dev/null" if silent else b""
+    # the command must not eat the commands that come after it on stdin
+    return b"{ %s\n} </dev/null%s; echo %s$?\n" % (
+        line.encode(),
+        redirect,
+        SESSION_SENTINEL,
+    )
+
+
+def one_shot_shell_command(cmd: list[str] | str) -> list[str]:
+    return [ADB_PATH, "shell", cmd if isinstance(cmd, str) else shlex.join(cmd)]
+
+
+def check_session_output(
+    cmd: list[str] | str, output: list[bytes], returncode: bytes
+) -> bytes:
+    output = b"".join(output)
+    if int(returncode) != 0:
+        raise CalledProcessError(int(returncode), cmd, output)
+    return output
+
+
+def decode_session_output(output: bytes) -> str:
+    return output.decode("UTF-8")
+
+
+class PmSession:
+    """A single long-lived `adb shell` that commands are fed to over stdin,
+    so running many of them doesn't pay for a new adb connection each time.
+    Falls back to one-shot `adb shell` calls if the shell can't be started."""
+
+    def __init__(self):
+        self.proc: Optional[Popen] = None
+
+    def __enter__(self) -> "PmSession":
+        try:
+            self.proc = Popen([ADB_PATH, "shell", "-T"], stdin=PIPE, stdout=PIPE)
+        except OSError:
+            self.proc = None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                # the shell is already gone, with our command stuck in the buffer
+                pass
+            self.proc.wait()
+            self.proc = None
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def run_bytes(self, cmd: list[str] | str, silent=False) -> bytes:
+        if self.proc is None:
+            return run_cmd_bytes(one_shot_shell_command(cmd), silent)
+
+        try:
+            self.proc.stdin.write(format_session_command(cmd, silent))
+            self.proc.stdin.flush()
+        except OSError:
+            # the shell died since the last command (e.g. adb was restarted)
+            return run_cmd_bytes(one_shot_shell_command(cmd), silent)
+
+        output = []
+        while True:
+            out_line = self.proc.stdout.readline()
+            if not out_line:
+                raise CalledProcessError(self.proc.wait(), cmd, b"".join(output))
+            out_line, sentinel, returncode = out_line.partition(SESSION_SENTINEL)
+            output.append(out_line)
+            if sentinel:
+                return check_session_output(cmd, output, returncode)
+
+    def run(self, cmd: list[str] | str, silent=False) -> str:
+        try:
+            return decode_session_output(self.run_bytes(cmd, silent))
+        except CalledProcessError as e:
+            e.output = decode_session_output(e.output)
+            raise
+
+
+class PmSessionPool:
+    """Lends out PmSessions to any number of threads, opening a new shell
+    only when all the open ones are busy, so each thread of a
+    ThreadPoolExecutor ends up with a shell of its own."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle: list[PmSession] = []
+        self._sessions: list[PmSession] = []
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions, self._idle = self._sessions, [], []
+        for session in sessions:
+            session.__exit__(None, None, None)
+
+    @contextmanager
+    def session(self) -> Iterator[PmSession]:
+        session = None
+        dead = []
+        with self._lock:
+            # idle shells can die while waiting (e.g. the device was replugged
+            # during a prompt), so those are dropped instead of handed out
+            while session is None and self._idle:
+                session = self._idle.pop()
+                if not session.alive:
+                    self._sessions.remove(session)
+                    dead.append(session)
+                    session = None
+        for dead_session in dead:
+            dead_session.__exit__(None, None, None)
+        if session is None:
+            session = PmSession().__enter__()
+            with self._lock:
+                self._sessions.append(session)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                alive = session.alive
+                if alive:
+                    self._idle.append(session)
+                elif session in self._sessions:
+                    self._sessions.remove(session)
+            # a shell that died while in use is dropped right away
+            if not alive:
+                session.__exit__(None, None, None)
+
+
+shells = PmSessionPool()
+atexit.register(shells.close)
+
+
+def run_shell(cmd: list[str] | str, silent=False) -> str:
+    with shells.session() as session:
+        return session.run(cmd, silent)
+
+
+def run_shell_bytes(cmd: list[str] | str, silent=False) -> bytes:
+    with shells.session() as session:
+        return session.run_bytes(cmd, silent)
+
+
+class AsyncPmSession:
+    """Same as PmSession, but driven by asyncio."""
+
+    def __init__(self):
+        self.proc: Optional[asyncio.subprocess.Process] = None
+
+    async def __aenter__(self) -> "AsyncPmSession":
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                ADB_PATH, "shell", "-T", stdin=PIPE, stdout=PIPE
+            )
+        except OSError:
+            self.proc = None
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            await self.proc.wait()
+            self.proc = None
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def run_lines(
+        self, cmd: list[str] | str, silent=False
+    ) -> AsyncIterator[bytes]:
+        """Yields the output of cmd line by line as it arrives."""
+        shell_died = False
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write(format_session_command(cmd, silent))
+                await self.proc.stdin.drain()
+            except OSError:
+                # the shell died since the last command (e.g. adb was restarted)
+                shell_died = True
+
+        if self.proc is None or shell_died:
+            output = await a_run_cmd(one_shot_shell_command(cmd), silent)
+            for out_line in output.encode().splitlines(keepends=True):
+                yield out_line
+            return
+
+        while True:
+            out_line = await self.proc.stdout.readline()
+            if not out_line:
+                raise CalledProcessError(await self.proc.wait(), cmd)
+            out_line, sentinel, returncode = out_line.partition(SESSION_SENTINEL)
+            if out_line:
+                yield out_line
+            if sentinel:
+                if int(returncode) != 0:
+                    raise CalledProcessError(int(returncode), cmd)
+                return
+
+
+class AsyncPmSessionPool:
+    """Lends out AsyncPmSessions to at most `size` tasks at a time, opening
+    new shells only when all the existing ones are busy.
+    Closes all of them on exit."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: list[AsyncPmSession] = []
+        self._sessions: list[AsyncPmSession] = []
+
+    async def __aenter__(self) -> "AsyncPmSessionPool":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for session in self._sessions:
+            await session.__aexit__(None, None, None)
+        self._sessions.clear()
+        self._idle.clear()
+
+    @asynccontextmanager
+    async def session(self):
+        async with self._semaphore:
+            session = None
+            # idle shells can die while waiting, so those are dropped
+            # instead of handed out
+            while session is None and self._idle:
+                session = self._idle.pop()
+                if not session.alive:
+                    self._sessions.remove(session)
+                    await session.__aexit__(None, None, None)
+                    session = None
+            if session is None:
+                session = await AsyncPmSession().__aenter__()
+                self._sessions.append(session)
+            try:
+                yield session
+            finally:
+                if session.alive:
+                    self._idle.append(session)
+                else:
+                    self._sessions.remove(session)
+                    await session.__aexit__(None, None, None)
+
+
+def check_pm_args(cmd: list[str]):
+    # for one-shot calls like run_pm_lines, adb joins the args with spaces for
+    # the device's shell to split again, so an arg with a space in it means
+    # something was joined by mistake (the shared shells quote their args)
+    assert all(" " not in arg for arg in cmd), f"pm args must be split: {cmd}"
+
+
 def run_pm(cmd: list[str], silent=False) -> str:
-    return run_cmd([ADB_PATH, "shell", "pm", *cmd], silent)
+    return run_shell(["pm", *cmd], silent)
+
+
+def run_pm_bytes(cmd: list[str], silent=False) -> bytes:
+    return run_shell_bytes(["pm", *cmd], silent)
+
+
+def run_pm_lines(cmd: list[str], silent=False) -> Iterator[bytes]:
+    check_pm_args(cmd)
+    return run_cmd_lines([ADB_PATH, "shell", "pm", *cmd], silent)
+
+
+BATCH_SENTINEL = b"__QUMUPAM_COMMAND_END__"
+
+
+def format_pm_batch_script(commands: list[list[str]]) -> str:
+    """Joins the pm commands into one script that marks the end of each
+    command's output with BATCH_SENTINEL, so a failing command doesn't stop
+    the rest and its output can be told apart."""
+    return "\n".join(
+        f"pm {shlex.join(cmd)} 2>&1; echo {BATCH_SENTINEL.decode()}$?"
+        for cmd in commands
+    )
+
+
+async def a_run_pm_batch(
+    commands: list[list[str]], session: AsyncPmSession
+) -> AsyncIterator[tuple[int, str]]:
+    """Runs all the pm commands in a single shell round-trip.
+    Yields (index, output) of each command as soon as it finishes."""
+    index = 0
+    current = []
+    async for out_line in session.run_lines(format_pm_batch_script(commands)):
+        out_line, sentinel, _ = out_line.partition(BATCH_SENTINEL)
+        current.append(out_line)
+        if sentinel:
+            yield index, decode_session_output(b"".join(current))
+            index += 1
+            current = []
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def download(url: str, f: BinaryIO):
+    """Streams url into the file f chunk by chunk, showing a progress bar."""
+    from tqdm import tqdm
+
+    with urllib.request.urlopen(url) as response:
+        total = int(response.headers.get("Content-Length", 0)) or None
+        with tqdm.wrapattr(
+            f, "write", total=total, unit="B", unit_scale=True, unit_divisor=1024
+        ) as out:
+            shutil.copyfileobj(response, out, DOWNLOAD_CHUNK_SIZE)
 
 
 def download_adb():
     url = get_adb_url()
 
-    with urllib.request.urlopen(url) as f:
-        data = f.read()
-
     CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    with zipfile.ZipFile(BytesIO(data)) as archive:
-        archive.extractall(CACHE_FOLDER)
+    with TemporaryFile() as f:
+        download(url, f)
+        f.seek(0)
+
+        with zipfile.ZipFile(f) as archive:
+            archive.extractall(CACHE_FOLDER)
 
     if platform.system() != "Windows":
         ADB_PATH.chmod(ADB_PATH.stat().st_mode | stat.S_IEXEC)
@@ -98,9 +460,48 @@ def wait_for_device():
     run_cmd([ADB_PATH, "wait-for-device"])
 
 
-class Package(NamedTuple):
-    name: str
-    label: Optional[str]
+class Package:
+    """An installed package. Packages are compared and hashed by name only:
+    the label is just for display, and a label that changed (or couldn't be
+    read this time) shouldn't make the same package look like a different one.
+    The label is None until looked up with resolve_labels."""
+
+    __slots__ = ("name", "label", "apk")
+
+    def __init__(
+        self, name: str, label: Optional[str] = None, apk: Optional[str] = None
+    ):
+        self.name = name
+        self.label = label
+        self.apk = apk
+
+    @classmethod
+    def get(
+        cls, name: str, label: Optional[str] = None, apk: Optional[str] = None
+    ) -> "Package":
+        """Returns the one Package object for this name, so every set of
+        packages shares the same objects. A label or apk, once known,
+        is filled in."""
+        package = _packages.get(name)
+        if package is None:
+            package = _packages[name] = cls(name, label, apk)
+        else:
+            if label is not None:
+                package.label = label
+            if apk is not None:
+                package.apk = apk
+        return package
+
+    def __eq__(self, other):
+        if not isinstance(other, Package):
+            return NotImplemented
+        return self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return f"Package({self.name!r}, {self.label!r}, {self.apk!r})"
 
     def __str__(self):
         if self.label is None:
@@ -109,7 +510,12 @@ class Package(NamedTuple):
             return f"{self.label} ({self.name})"
 
 
-def get_packages(uid=None, third_party_only=True, progress_bar=True) -> set[Package]:
+_packages: dict[str, Package] = {}
+
+
+def get_packages(uid=None, third_party_only=True) -> set[Package]:
+    """Returns packages along with their apk paths, but without labels:
+    those are slow to get and only needed for display, see resolve_labels."""
     pm_command = ["list", "packages", "-f"]
     if uid is not None:
         pm_command += ["--user", str(uid)]
@@ -118,45 +524,67 @@ def get_packages(uid=None, third_party_only=True, progress_bar=True) -> set[Pack
     if third_party_only:
         pm_command += ["-3"]
 
-    pm_output = run_pm(pm_command).split()
+    packages = set()
+    for line in run_pm_lines(pm_command):
+        match = package_line_regex.match(line)
+        if match is None:
+            continue
+        apk, name = match.group(1).decode(), match.group(2).decode()
+        packages.add(Package.get(name, apk=apk))
 
-    packages = []
+    return packages
 
-    if progress_bar:
-        pm_output_it = tqdm(pm_output)
-    else:
-        pm_output_it = iter(pm_output)
 
-    for line in pm_output_it:
-        line = line.removeprefix("package:")
-        i = line.rfind("=")
-        name = line[i + 1 :]
-        apk = line[:i]
-        packages.append(Package(name, get_apk_label(apk)))
+def resolve_labels(packages: Iterable[Package], progress_bar=True) -> list[Package]:
+    """Looks up labels of the given packages and fills them in."""
+    packages = list(packages)
 
-    return set(packages)
+    # labels already in the cache don't need the package manager at all
+    apk_labels = get_apk_labels(
+        (package.apk for package in packages if package.apk is not None),
+        dump=False,
+    )
+    uncached = [package for package in packages if package.apk not in apk_labels]
+
+    labels = (get_package_manager_labels() or {}) if uncached else {}
+    apk_labels.update(
+        get_apk_labels(
+            (
+                package.apk
+                for package in uncached
+                if package.name not in labels and package.apk is not None
+            ),
+            progress_bar=progress_bar,
+        )
+    )
+
+    for package in packages:
+        if package.apk in apk_labels:
+            package.label = apk_labels[package.apk]
+        elif package.name in labels:
+            package.label = labels[package.name]
+
+    return packages
 
 
 def download_aapt2():
     url = "https://github.com/rendiix/termux-aapt/raw/main/prebuilt-binary-android-12%2B/arm64/aapt2"
 
-    with urllib.request.urlopen(url) as f:
-        data = f.read()
-
-    with TemporaryDirectory() as tdir:
-        path = Path(tdir) / "aapt2"
-        path = str(path)
+    if not AAPT2_PATH.exists() or AAPT2_PATH.stat().st_size == 0:
+        CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+        partial_path = AAPT2_PATH.with_suffix(".part")
 
-        with open(path, "wb") as f:
-            f.write(data)
+        with open(partial_path, "wb") as f:
+            download(url, f)
 
-        run_cmd([ADB_PATH, "push", path, AAPT2_PATH_ON_DEVICE])
+        partial_path.replace(AAPT2_PATH)
 
-    run_cmd([ADB_PATH, "shell", "chmod", "+x", AAPT2_PATH_ON_DEVICE])
+    run_cmd([ADB_PATH, "push", str(AAPT2_PATH), AAPT2_PATH_ON_DEVICE])
+    run_shell(["chmod", "+x", AAPT2_PATH_ON_DEVICE])
 
 
 def run_aapt2(cmd: list[str], silent=False) -> str:
-    return run_cmd([ADB_PATH, "shell", AAPT2_PATH_ON_DEVICE, *cmd], silent)
+    return run_shell([AAPT2_PATH_ON_DEVICE, *cmd], silent)
 
 
 def check_aapt2_works() -> bool:
@@ -167,22 +595,178 @@ def check_aapt2_works() -> bool:
         return e.returncode == 1
 
 
-@cachier(cache_dir=CACHE_FOLDER / 'apk_labels', pickle_reload=False)
-def get_apk_label(path: str) -> Optional[str]:
-    try:
-        aapt2_out = run_aapt2(["dump", "badging", path], silent=True).split("\n")
-    except CalledProcessError:
-        return None
+MAX_SHELL_COMMAND_LENGTH = 100_000
+
 
-    label_line = next((s for s in aapt2_out if s.startswith("application-label")), None)
+def chunk_args(args: list[str], max_length=MAX_SHELL_COMMAND_LENGTH):
+    """Splits args into chunks that stay under max_length once quoted for the
+    shell, so batched commands don't overflow the device's command line."""
+    chunk = []
+    length = 0
+    for arg in args:
+        arg_length = len(shlex.quote(arg)) + 1
+        if chunk and length + arg_length > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(arg)
+        length += arg_length
+    if chunk:
+        yield chunk
 
-    if label_line is None:
+
+def parse_label_line(label_line: bytes) -> Optional[str]:
+    match = label_line_regex.search(label_line)
+    if match is None:
         return None
+    return match.group(1).decode("UTF-8")
+
+
+def dump_apk_labels_batch(apks: list[str]) -> dict[str, Optional[str]]:
+    """Runs aapt2 on all the given apks from within a single `adb shell`
+    instead of connecting once per apk. Only the label line of each dump
+    is sent back, filtered on the device."""
+    script = (
+        f"for a in {shlex.join(apks)}; do "
+        "printf '\\0%s\\0' \"$a\"; "
+        f'{AAPT2_PATH_ON_DEVICE} dump badging "$a" 2>/dev/null '
+        "| grep -m1 '^application-label'; "
+        "done; true"
+    )
+    output = run_shell_bytes(script, silent=True)
+
+    # "\0<apk>\0<label line, if any>" for every apk; paths can't contain \0
+    parts = output.split(b"\0")
+    return {
+        apk.decode("UTF-8"): parse_label_line(label_line)
+        for apk, label_line in zip(parts[1::2], parts[2::2])
+    }
+
+
+def dump_apk_labels(
+    apks: list[str], progress_bar=False
+) -> Iterator[dict[str, Optional[str]]]:
+    """Splits apks into batches for dump_apk_labels_batch, one per worker (or
+    more if a batch would overflow the command line), and runs them in
+    parallel so that aapt2 isn't limited to one core on the device.
+    Yields the labels of each batch as soon as it's done."""
+    from tqdm import tqdm
+
+    workers = get_concurrency()
+    batch_size = max(1, -(-len(apks) // workers))
+    batches = [
+        chunk
+        for i in range(0, len(apks), batch_size)
+        for chunk in chunk_args(apks[i : i + batch_size])
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=len(apks), disable=not progress_bar
+    ) as bar:
+        futures = {
+            executor.submit(dump_apk_labels_batch, batch): batch for batch in batches
+        }
+        for future in as_completed(futures):
+            bar.update(len(futures[future]))
+            try:
+                batch_labels = future.result()
+            except (CalledProcessError, OSError):
+                # the apks of a failed batch are left unlabelled (and uncached)
+                # rather than losing the labels of all the other batches
+                continue
+            yield batch_labels
+
+
+def get_apk_stats(apks: Iterable[str]) -> dict[str, tuple[int, int]]:
+    """Returns (size, mtime) of each of the given files on the device,
+    fetched with a single `stat` call per chunk.
+    Files that can't be stat'ed are left out."""
+    stats = {}
+
+    for chunk in chunk_args(list(apks)):
+        stat_command = shlex.join(["stat", "-c", "%s %Y %n", *chunk])
+        try:
+            stat_output = run_shell(stat_command, silent=True)
+        except CalledProcessError as e:
+            stat_output = e.output
+
+        for line in stat_output.splitlines():
+            size, mtime, apk = line.split(" ", 2)
+            stats[apk] = (int(size), int(mtime))
+
+    return stats
+
+
+# the lowest limit on "?" placeholders in a query among sqlite versions
+SQLITE_MAX_VARIABLES = 999
+
+
+def open_label_cache() -> sqlite3.Connection:
+    CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(LABEL_CACHE_PATH)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS labels "
+        "(apk_path TEXT PRIMARY KEY, size INT, mtime INT, label TEXT)"
+    )
+    return db
+
+
+_apk_labels_this_run: dict[str, Optional[str]] = {}
+
+
+def get_apk_labels(
+    apks: Iterable[str], progress_bar=False, dump=True
+) -> dict[str, Optional[str]]:
+    """Returns labels of the given apks. Labels are cached on disk keyed by the
+    apk's path, size and mtime, so aapt2 only runs for new or changed apks.
+    With dump=False, only the cached labels are returned and aapt2 isn't run."""
+    apks = set(apks)
+    labels = {
+        apk: _apk_labels_this_run[apk] for apk in apks if apk in _apk_labels_this_run
+    }
+    stats = get_apk_stats(apk for apk in apks if apk not in labels)
+
+    with closing(open_label_cache()) as db:
+        # only the apks being looked up are read, since every app update
+        # leaves a row for the old path behind
+        lookup = list(stats)
+        for i in range(0, len(lookup), SQLITE_MAX_VARIABLES):
+            chunk = lookup[i : i + SQLITE_MAX_VARIABLES]
+            rows = db.execute(
+                "SELECT * FROM labels WHERE apk_path IN "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for apk, size, mtime, label in rows:
+                if stats[apk] == (size, mtime):
+                    labels[apk] = label
+
+        misses = [apk for apk in apks if apk not in labels] if dump else []
+
+        for dumped in dump_apk_labels(misses, progress_bar=progress_bar):
+            labels.update(dumped)
+            # each batch is saved right away, so an interrupted first run
+            # doesn't have to dump everything again
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)",
+                    (
+                        (apk, *stats[apk], label)
+                        for apk, label in dumped.items()
+                        if apk in stats
+                    ),
+                )
+
+        for apk in misses:
+            labels.setdefault(apk, None)
+
+    _apk_labels_this_run.update(labels)
+
+    return labels
 
-    a = label_line.find("'")
-    b = label_line.rfind("'", a + 1)
 
-    return label_line[a + 1 : b]
+def get_apk_label(path: str) -> Optional[str]:
+    return get_apk_labels([path])[path]
 
 
 def get_apk_path(package_name) -> str:
@@ -190,8 +774,150 @@ def get_apk_path(package_name) -> str:
 
 
 def get_package_label(package_name) -> Optional[str]:
-    apk = get_apk_path(package_name)
-    return get_apk_label(apk)
+    """Looks up the apk path and runs aapt2 on it in one `adb shell` call."""
+    script = (
+        f"p=$(pm path {shlex.quote(package_name)} | head -n1 | cut -d: -f2); "
+        f'{AAPT2_PATH_ON_DEVICE} dump badging "$p" 2>/dev/null '
+        "| grep -m1 '^application-label'; "
+        "true"
+    )
+    label_line = run_shell_bytes(script, silent=True)
+
+    return parse_label_line(label_line)
+
+
+class LabelSource(Enum):
+    PmList = 0
+    Dumpsys = 1
+    Aapt2 = 2
+
+
+_label_source: Optional[LabelSource] = None
+
+
+def load_label_source() -> Optional[LabelSource]:
+    try:
+        return LabelSource[LABEL_SOURCE_PATH.read_text().strip()]
+    except (OSError, KeyError):
+        return None
+
+
+def save_label_source(source: LabelSource):
+    global _label_source
+    _label_source = source
+    try:
+        CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+        LABEL_SOURCE_PATH.write_text(source.name)
+    except OSError:
+        pass
+
+
+def get_pm_list_labels() -> dict[str, str]:
+    try:
+        pm_output = run_pm(["list", "packages", "-l"], silent=True)
+    except CalledProcessError:
+        return {}
+    return dict(pm_label_regex.findall(pm_output))
+
+
+_dumpsys_packages: Optional[str] = None
+
+
+def get_dumpsys_packages() -> str:
+    """Returns the lines of `dumpsys package packages` with the package names,
+    their labels and the users that have them. It dumps the whole package
+    database, so it's fetched once and kept for the rest of the run."""
+    global _dumpsys_packages
+    if _dumpsys_packages is None:
+        _dumpsys_packages = run_shell(
+            "dumpsys package packages "
+            "| grep -E 'Package \\[|User [0-9]+: |nonLocalizedLabel='",
+            silent=True,
+        )
+    return _dumpsys_packages
+
+
+def get_dumpsys_labels() -> dict[str, str]:
+    try:
+        dumpsys_output = get_dumpsys_packages()
+    except CalledProcessError:
+        return {}
+
+    labels = {}
+    name = None
+    for line in dumpsys_output.splitlines():
+        if match := dumpsys_package_regex.search(line):
+            name = match.group(1)
+        elif name is not None and (match := dumpsys_label_regex.search(line)):
+            if match.group(1) != "null":
+                labels[name] = match.group(1)
+    return labels
+
+
+def get_package_manager_labels() -> Optional[dict[str, str]]:
+    """Tries to get labels of all packages straight from the package manager
+    in a single call, which is a lot faster than running aapt2 on every apk.
+    Returns None if the device doesn't expose them. Which way works is
+    saved under CACHE_FOLDER, so later runs try it first and only probe the
+    others if it stops working."""
+    global _label_source
+
+    if _label_source is None:
+        _label_source = load_label_source()
+    if _label_source == LabelSource.Aapt2:
+        return None
+
+    sources = [
+        (LabelSource.PmList, get_pm_list_labels),
+        (LabelSource.Dumpsys, get_dumpsys_labels),
+    ]
+    sources.sort(key=lambda source: source[0] != _label_source)
+
+    for source, get_labels in sources:
+        labels = get_labels()
+        if labels:
+            save_label_source(source)
+            return labels
+
+    save_label_source(LabelSource.Aapt2)
+    return None
+
+
+def get_package_names(uid=None, third_party_only=True) -> set[str]:
+    """Like get_packages, but only lists names, without looking up apks or labels."""
+    pm_command = ["list", "packages"]
+    if uid is not None:
+        pm_command += ["--user", str(uid)]
+    else:
+        pm_command += ["-a"]
+    if third_party_only:
+        pm_command += ["-3"]
+
+    pm_output = run_pm_bytes(pm_command).split()
+
+    return {line.removeprefix(b"package:").decode() for line in pm_output}
+
+
+def get_all_users_packages() -> dict[int, set[str]]:
+    """Returns names of packages installed for every user, keyed by uid, all
+    taken from a single `dumpsys package packages` call. Includes system
+    packages. Returns an empty dict if the output isn't in the expected shape."""
+    try:
+        dumpsys_output = get_dumpsys_packages()
+    except CalledProcessError:
+        return {}
+
+    users_packages = {}
+    name = None
+    for line in dumpsys_output.splitlines():
+        if match := dumpsys_package_regex.search(line):
+            name = match.group(1)
+        elif name is not None and (match := dumpsys_user_regex.search(line)):
+            uid, installed = match.groups()
+            names = users_packages.setdefault(int(uid), set())
+            if installed == "true":
+                names.add(name)
+    return users_packages
 
 
 class User(NamedTuple):
@@ -200,54 +926,151 @@ class User(NamedTuple):
     packages: set[Package]
 
 
-def get_users() -> list[User]:
-    pm_output = run_pm(["list", "users"])
+def get_users(all_packages: Optional[set[Package]] = None) -> list[User]:
+    """Returns all users on the device. Their packages are picked from
+    all_packages by name, so apks aren't scanned again for every user.
+    Without all_packages, packages are listed by name only."""
+    # these adb calls don't depend on each other, so they all run at once
+    with ThreadPoolExecutor(max_workers=get_concurrency()) as executor:
+        if all_packages is None:
+            names_future = executor.submit(get_package_names)
+        users_packages_future = executor.submit(get_all_users_packages)
 
-    pm_output = pm_output.removeprefix("Users:\n")
-    pm_output = [s.removeprefix("\tUserInfo{") for s in pm_output.split("\n")]
-    pm_output = pm_output[:-1]
+        pm_output = run_pm(["list", "users"])
+        user_infos = [
+            (int(match.group(1)), match.group(2))
+            for match in user_info_regex.finditer(pm_output)
+        ]
 
-    users = []
-    for s in pm_output:
-        a = s.find(":")
-        b = s.find(":", a + 1)
-        name = s[a + 1 : b]
-        uid = int(s[:a])
+        users_packages = users_packages_future.result()
+        missing = [uid for uid, _ in user_infos if uid not in users_packages]
+        users_packages.update(zip(missing, executor.map(get_package_names, missing)))
 
-        packages = get_packages(uid, progress_bar=False)
+        if all_packages is None:
+            all_packages = {Package.get(name) for name in names_future.result()}
 
+    users = []
+    for uid, name in user_infos:
+        names = users_packages[uid]
+        packages = {package for package in all_packages if package.name in names}
         users.append(User(name, uid, packages))
 
     return users
 
 
+def get_install_command(package: Package, uid: int) -> list[str]:
+    return ["install-existing", "--user", str(uid), package.name]
+
+
 def install_existing(package: Package, uid: int) -> str:
-    return run_pm(["install-existing", "--user", str(uid), package.name])
+    return run_pm(get_install_command(package, uid))
 
 
-def uninstall(package: Package, uid: Optional[int], preserve_data=True) -> str:
+def get_uninstall_command(
+    package: Package, uid: Optional[int], preserve_data: bool
+) -> list[str]:
     pm_command = ["uninstall"]
     if uid is not None:
         pm_command += ["--user", str(uid)]
     if preserve_data:
         pm_command += ["-k"]
     pm_command += [package.name]
-    return run_pm(pm_command)
+    return pm_command
+
 
+def uninstall(package: Package, uid: Optional[int], preserve_data=True) -> str:
+    return run_pm(get_uninstall_command(package, uid, preserve_data))
+
+
+async def process_packages(
+    packages: Iterable[Package], get_command, sessions: AsyncPmSessionPool
+) -> AsyncIterator[tuple[Package, str]]:
+    """Runs the pm command `get_command(package)` for every package. The
+    packages are split into one batch per shell of the pool, and every batch
+    is sent to its shell as a single script.
+    Yields (package, output) as the commands finish."""
+    packages = list(packages)
+    batches = [packages[i :: sessions.size] for i in range(sessions.size)]
+    batches = [batch for batch in batches if batch]
+    finished = asyncio.Queue()
+
+    async def run(batch):
+        try:
+            async with sessions.session() as session:
+                commands = [get_command(package) for package in batch]
+                async for index, output in a_run_pm_batch(commands, session):
+                    await finished.put((batch[index], output))
+        finally:
+            await finished.put(None)
+
+    tasks = [asyncio.create_task(run(batch)) for batch in batches]
+    running = len(tasks)
+    while running:
+        result = await finished.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+
+    for task in tasks:
+        # re-raises anything that went wrong in the batch
+        task.result()
+
+
+GREEN = "\x1b[32m"
+RESET = "\x1b[0m"
+
+
+class SuccessPrinter:
+    """Prints "SUCCESS:" lines with plain ANSI codes instead of pytermgui markup,
+    batched into one write at most every `interval` seconds.
+    Call flush() before printing anything else to keep the order."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lines: list[str] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def __enter__(self) -> "SuccessPrinter":
+        return self
 
-def get_unsafe_to_uninstall(users: list[User]) -> set[str]:
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def print(self, message: str):
+        self.lines.append(f"{GREEN}SUCCESS:{RESET} {message}\n")
+        if self.timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # nothing to schedule the flush on, so there's nothing to wait for
+                self.flush()
+                return
+            self.timer = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.lines:
+            sys.stdout.write("".join(self.lines))
+            sys.stdout.flush()
+            self.lines.clear()
+
+
+def get_unsafe_to_uninstall(users: list[User]) -> set[Package]:
     """Returns packages that are installed for only one user.
     These should be removed completely on uninstall, or will be
     left hanging with no ability to install back (without reinstalling)."""
-    seen = set()
-    safe = set()
+    counts = Counter()
     for user in users:
-        safe.update(user.packages.intersection(seen))
-        seen.update(user.packages)
-    return seen.difference(safe)
+        counts.update(user.packages)
+    return {package for package, count in counts.items() if count == 1}
 
 
 def prompt_for_user(users) -> Optional[User]:
+    import inquirer as inq
+
     choices = [(user.name, user) for user in users]
 
     if len(users) == 1 or choices[0][1].uid == 0:
@@ -278,6 +1101,8 @@ class Mode(Enum):
 
 
 def prompt_for_preserve_data() -> Optional[bool]:
+    import inquirer as inq
+
     questions = [
         inq.Confirm(
             name="preserve_data",
@@ -295,6 +1120,8 @@ def prompt_for_preserve_data() -> Optional[bool]:
 
 
 def prompt_for_mode() -> Optional[Mode]:
+    import inquirer as inq
+
     questions = [
         inq.List(
             "mode",
@@ -330,17 +1157,17 @@ def prompt_for_mode() -> Optional[Mode]:
 def prompt_for_packages(
     all_packages: Iterable[Package], cur_packages: Iterable[Package]
 ) -> Optional[Iterable[Package]]:
-    all_packages = list(all_packages)
-    cur_packages = list(cur_packages)
+    import inquirer as inq
 
-    all_packages.sort(key=str)
+    choices = [(str(package), package) for package in all_packages]
+    choices.sort(key=lambda choice: choice[0])
 
     questions = [
         inq.Checkbox(
             "packages",
             message="Select packages (right to select, left to deselect)",
-            choices=[(str(package), package) for package in all_packages],
-            default=cur_packages,
+            choices=choices,
+            default=list(cur_packages),
         )
     ]
 
@@ -352,5 +1179,17 @@ def prompt_for_packages(
     return answers["packages"]
 
 
-install_success_regex = re.compile(r"Package (.*) installed for user: (.*)")
-uninstall_success_regex = re.compile(r"Success")
+# the apk path can contain "=" itself, so the name is whatever follows the last one
+package_line_regex = re.compile(rb"^package:(.+)=(\S+)\s*$", re.MULTILINE)
+# greedy, since the label itself can contain quotes
+label_line_regex = re.compile(rb"^application-label[^:]*:'(.*)'", re.MULTILINE)
+user_info_regex = re.compile(r"UserInfo\{(\d+):([^:]*):")
+pm_label_regex = re.compile(r"^package:(\S+)\s+label:(.*?)\s*$", re.MULTILINE)
+dumpsys_package_regex = re.compile(r"Package \[(\S+)\]")
+dumpsys_user_regex = re.compile(r"^\s*User (\d+):.*?\binstalled=(true|false)\b")
+dumpsys_label_regex = re.compile(r"nonLocalizedLabel=(.*?)(?=\s+\w+=|\s*$)")
+# output can come with "\r\n" line endings, like in package_line_regex
+install_success_regex = re.compile(
+    r"^Package (\S+) installed for user: (\S+?)\r?$", re.MULTILINE
+)
+uninstall_success_regex = re.compile(r"^Success\r?$", re.MULTILINE)